@@ -1,13 +1,18 @@
 import os
 import sys
 import shutil
+import tarfile
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import re
 import requests
 from datetime import datetime, timedelta
 import pytz
 import json
+from email.utils import parsedate_to_datetime
 import platform
 import logging
+from app import profiling
 
 # Set up logging for errors
 # logging.basicConfig(filename='errors.log', level=logging.ERROR,
@@ -92,6 +97,31 @@ def load_config():
         error_logger.error("Error: config.json file is not a valid JSON file.")
         return None
 
+def config_flag(key, default=False) -> bool:
+    """
+    Read an on/off option from the configuration.
+
+    Args:
+        key (str): Key in config.json. Ex: 'delta_sync'
+        default (bool): Value used when the key is missing.
+
+    Returns:
+        bool: True for true/"True"/"true", otherwise False.
+    """
+    value = config.get(key, default)
+    if isinstance(value, str):
+        return value.strip().lower() == "true"
+    return bool(value)
+
+# Compressions supported for archives, both release the GIL while compressing
+ARCHIVE_COMPRESSIONS = ('gz', 'xz')
+
+# Orders the space planner can pick folders in
+RECLAIM_PRIORITIES = ('largest', 'oldest')
+
+# sha256sum compatible list of archives, kept in the archive location
+ARCHIVE_MANIFEST = 'manifest.sha256'
+
 config = load_config()
 
 if config:
@@ -100,14 +130,54 @@ if config:
     DELETION_LOCATION = adjust_path(config['deletion_location'])
 
     # Optionally toggle on grabbing size info for ticket
-    if not config['get_size']:
-        GET_SIZE_BOOL = config['get_size']
-    else:
-        GET_SIZE_BOOL = False
+    GET_SIZE_BOOL = config_flag('get_size')
+
+    # Only ask Service-Now for rows changed since the last successful load
+    DELTA_SYNC_BOOL = config_flag('delta_sync')
+    SYNC_STATE_PATH = adjust_path(APPLICATION_PATH + '/sync_state.json')
+
+    # Pull closed tickets for the whole retention window instead of one ticket at a time
+    WINDOWED_QUERY_BOOL = config_flag('windowed_query')
+    # Tickets closed more than this many days ago are left to the per-ticket fetch when using the windowed query
+    RETENTION_WINDOW_DAYS = int(config.get('retention_window_days', 365))
+
+    # Order used to pick folders when freeing a set amount of space: "largest" or "oldest"
+    RECLAIM_PRIORITY = config.get('reclaim_priority', 'largest')
+    if RECLAIM_PRIORITY not in RECLAIM_PRIORITIES:
+        error_logger.error(f"Error: unknown reclaim_priority '{RECLAIM_PRIORITY}', using 'largest'.")
+        RECLAIM_PRIORITY = 'largest'
+
+    # Optionally compress folders into an archive volume before they are permanently deleted
+    ARCHIVE_LOCATION = adjust_path(config['archive_location']) if config.get('archive_location') else None
+    ARCHIVE_COMPRESSION = config.get('archive_compression', 'gz')
+    if ARCHIVE_COMPRESSION not in ARCHIVE_COMPRESSIONS:
+        error_logger.error(f"Error: unknown archive_compression '{ARCHIVE_COMPRESSION}', using 'gz'.")
+        ARCHIVE_COMPRESSION = 'gz'
+    # Each xz compressor needs about 94 MiB, so the default is capped to keep memory bounded
+    ARCHIVE_WORKERS = int(config.get('archive_workers', min(os.cpu_count() or 1, 4)))
+
+    # Write CPU and allocation reports for slow runs, can also be turned on with --profile
+    if config_flag('profile'):
+        profiling.PROFILE_ENABLED = True
 else:
     error_logger.error("Error: unable to load configuration.\nA 'config.json' needs to be in the same directory as this app.")
     exit()
 
+# sys_id of the "Ready for Pickup" label in Service-Now
+READY_FOR_PICKUP_LABEL_ID = "0874ad561b6b9d147881db13dd4bcb96"
+
+# Max ticket numbers sent in a single "numberIN" query to keep URLs short
+QUERY_BATCH_SIZE = 100
+
+# Rows requested per page when paging through a Service-Now table
+PAGE_SIZE = 1000
+
+# How long after a ticket is closed before its backup may be deleted
+RETENTION_PERIOD = timedelta(weeks=2)
+
+# Folder sizes in bytes keyed by path, filled by scan_local_backups and cached_folder_size
+FOLDER_SIZE_CACHE = {}
+
 def perm_remove_directory(folder_to_delete) -> bool:
     try:
         folder_to_delete_path = os.path.join(DELETION_LOCATION, folder_to_delete)
@@ -145,6 +215,52 @@ def scan_directory_for_tickets(directory):
                 ticket_numbers.append(match.group())
     return ticket_numbers
 
+def scan_local_backups(directory):
+    """
+    Scan the specified directory once for ticket folders. Sizes are filled in later by size_local_backups.
+
+    Needs no Service-Now credentials, so it can run while the user is still logging in.
+
+    Args:
+        directory (str): The directory to scan.
+
+    Returns:
+        dict: {ticket_number: {'folder_name': str, 'folder_bytes': None}}
+    """
+    ticket_pattern = re.compile(r'TKT\d{7}')
+    local_backups = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                match = ticket_pattern.search(entry.name)
+                if match and match.group() not in local_backups:
+                    local_backups[match.group()] = {'folder_name': entry.name, 'folder_bytes': None}
+    debug_logger.debug(f"Scanned {len(local_backups)} ticket folders in {directory}")
+    return local_backups
+
+def size_local_backups(directory, local_backups, stop_event=None):
+    """
+    Fill in the size of every folder found by scan_local_backups.
+
+    Args:
+        directory (str): The directory that was scanned.
+        local_backups (dict): Result of scan_local_backups. Updated in place.
+        stop_event (threading.Event): Stops sizing early when set, leaving the remaining sizes as None.
+    """
+    with profiling.profile_section('get_folder_size'):
+        for ticket_number, local_info in local_backups.items():
+            if stop_event and stop_event.is_set():
+                debug_logger.debug(f"Stopped sizing folders in {directory}")
+                return
+            debug_logger.debug(f"Getting backup size info for ticket: {ticket_number}")
+            folder_path = os.path.join(directory, local_info['folder_name'])
+            folder_bytes = get_folder_size(folder_path, stop_event)
+            # A walk cut short by stop_event is not a real size
+            if stop_event and stop_event.is_set():
+                return
+            local_info['folder_bytes'] = folder_bytes
+            FOLDER_SIZE_CACHE[folder_path] = folder_bytes
+
 def find_matching_folder_name(directory, ticket_number):
     for folder_name in os.listdir(directory):
         if os.path.isdir(os.path.join(directory, folder_name)):
@@ -158,17 +274,18 @@ def move_to_deletion_folder(ticket_numbers):
     Args:
         ticket_numbers (list): A list of ticket numbers (e.g., "TKTXXXXXXX").
     """
-    for ticket_number in ticket_numbers:
-        for folder_name in os.listdir(BACKUPS_LOCATION):
-            if os.path.isdir(os.path.join(BACKUPS_LOCATION, folder_name)):
-                if ticket_number in folder_name:
-                    folder_path = os.path.join(BACKUPS_LOCATION, folder_name)
-                    deletion_path = os.path.join(DELETION_LOCATION, folder_name)
-                    try:
-                        shutil.move(folder_path, deletion_path)
-                        # debug_logger.debug(f"Moved {folder_name} to {DELETION_LOCATION}")
-                    except Exception as e:
-                        error_logger.error(f"Error moving {folder_name}: {e}")
+    with profiling.profile_section('move_to_deletion_folder'):
+        for ticket_number in ticket_numbers:
+            for folder_name in os.listdir(BACKUPS_LOCATION):
+                if os.path.isdir(os.path.join(BACKUPS_LOCATION, folder_name)):
+                    if ticket_number in folder_name:
+                        folder_path = os.path.join(BACKUPS_LOCATION, folder_name)
+                        deletion_path = os.path.join(DELETION_LOCATION, folder_name)
+                        try:
+                            shutil.move(folder_path, deletion_path)
+                            # debug_logger.debug(f"Moved {folder_name} to {DELETION_LOCATION}")
+                        except Exception as e:
+                            error_logger.error(f"Error moving {folder_name}: {e}")
 
 def fetch_username_info(instance, username, password, closed_by_id):
     """
@@ -217,7 +334,7 @@ def fetch_label_info(instance, username, password, ticket_number):
         if data_label_entry['result']:
             for entry in data_label_entry['result']:
                 if len(entry.keys()) > 0:
-                    if entry['label']['value'] == "0874ad561b6b9d147881db13dd4bcb96":
+                    if entry['label']['value'] == READY_FOR_PICKUP_LABEL_ID:
                         has_ready_for_pickup_tag = True
                         break
     else:
@@ -235,18 +352,21 @@ def find_matching_folders(backups_location, ticket_number) -> str:
 
     return matching_folders[0]
 
-def get_folder_size(folder_path):
+def get_folder_size(folder_path, stop_event=None):
     """
     Calculate the total size of a folder in bytes.
 
     Args:
         folder_path (str): The path of the folder.
+        stop_event (threading.Event): Stops the walk early when set.
 
     Returns:
         int: Total size of the folder in bytes.
     """
     total_size = 0
     for dirpath, dirnames, filenames in os.walk(folder_path):
+        if stop_event and stop_event.is_set():
+            break
         for f in filenames:
             fp = os.path.join(dirpath, f)
             try:
@@ -256,6 +376,99 @@ def get_folder_size(folder_path):
                 error_logger.error(f"Error getting size for file {fp}:\n\t{e}")
     return total_size
 
+def cached_folder_size(folder_path):
+    """
+    Get the size of a folder in bytes, only walking it the first time it is asked for.
+
+    Args:
+        folder_path (str): The path of the folder.
+
+    Returns:
+        int: Total size of the folder in bytes.
+    """
+    if folder_path not in FOLDER_SIZE_CACHE:
+        FOLDER_SIZE_CACHE[folder_path] = get_folder_size(folder_path)
+    return FOLDER_SIZE_CACHE[folder_path]
+
+def deletion_on_same_volume() -> bool:
+    """
+    Check if the deletion folder is on the same volume as the backups.
+
+    Returns:
+        bool: True if moving a folder to DELETION_LOCATION frees nothing until it is emptied.
+    """
+    try:
+        return os.stat(BACKUPS_LOCATION).st_dev == os.stat(DELETION_LOCATION).st_dev
+    except OSError as e:
+        error_logger.error(f"Error comparing backup and deletion volumes: {e}")
+        return True
+
+def plan_space_reclamation(ticket_info_list, target_bytes, priority=RECLAIM_PRIORITY, on_sized=None):
+    """
+    Pick the backups ready for deletion to move so that at least target_bytes are freed.
+
+    With "oldest", folders are taken from the longest closed ticket onwards and only
+    sized until the target is covered. With "largest", every folder is sized, the
+    biggest are taken until the target is reached, then any picked folder that is not
+    needed to stay above the target is dropped again.
+
+    Args:
+        ticket_info_list (list): Ticket information from build_ticket_info.
+        target_bytes (int): Amount of space to free in bytes.
+        priority (str): "largest" to prefer the biggest folders, "oldest" to prefer the longest closed tickets.
+        on_sized (callable): Called with each candidate folder name once its size is known.
+
+    Returns:
+        tuple: (list of ticket information to move, total bytes freed by moving them)
+    """
+    candidates = []
+    for info in ticket_info_list:
+        if not info['ready_for_deletion'] or not info['folder_name']:
+            continue
+        folder_path = os.path.join(BACKUPS_LOCATION, info['folder_name'])
+        if os.path.isdir(folder_path):
+            candidates.append((folder_path, info))
+
+    def folder_size(folder_path, info):
+        folder_bytes = info.get('folder_bytes')
+        if folder_bytes is None:
+            folder_bytes = cached_folder_size(folder_path)
+        if on_sized:
+            on_sized(info['folder_name'])
+        return folder_bytes
+
+    plan = []
+    total_bytes = 0
+    with profiling.profile_section('get_folder_size'):
+        if priority == "oldest":
+            # "YYYY-MM-DD HH:MM:SS" sorts oldest first as a plain string
+            candidates.sort(key=lambda candidate: candidate[1]['closed_at_local'][:19])
+            for folder_path, info in candidates:
+                if total_bytes >= target_bytes:
+                    break
+                plan.append(info)
+                total_bytes += folder_size(folder_path, info)
+        else:
+            sized = [(folder_size(folder_path, info), info) for folder_path, info in candidates]
+            sized.sort(key=lambda candidate: (-candidate[0], candidate[1]['closed_at_local'][:19]))
+
+            selected = []
+            for folder_bytes, info in sized:
+                if total_bytes >= target_bytes:
+                    break
+                selected.append((folder_bytes, info))
+                total_bytes += folder_bytes
+
+            # Drop folders the target does not need, smallest (last picked) first
+            for folder_bytes, info in reversed(selected):
+                if total_bytes - folder_bytes >= target_bytes:
+                    total_bytes -= folder_bytes
+                else:
+                    plan.insert(0, info)
+
+    debug_logger.debug(f"Reclaim plan for {target_bytes} bytes ({priority}): {len(plan)} folders, {total_bytes} bytes")
+    return plan, total_bytes
+
 def human_readable_size(size):
     """
     Convert a size in bytes to a human-readable format with the appropriate unit.
@@ -271,9 +484,25 @@ def human_readable_size(size):
             return f"{size:.2f} {unit}"
         size /= 1024
 
-def fetch_ticket_info(instance, username, password, ticket_number):
+def server_timestamp(response):
     """
-    Fetch the information of a ticket from the ServiceNow instance.
+    Read the Service-Now server time from the "Date" header of a response.
+
+    Args:
+        response (requests.Response): Response from the Service-Now instance.
+
+    Returns:
+        str: UTC time in Service-Now format. Ex: '2025-03-01 14:05:09'
+    """
+    try:
+        server_time = parsedate_to_datetime(response.headers['Date'])
+        return server_time.astimezone(pytz.utc).strftime('%Y-%m-%d %H:%M:%S')
+    except (KeyError, TypeError, ValueError):
+        return datetime.now(pytz.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def fetch_ticket_record(instance, username, password, ticket_number):
+    """
+    Fetch the raw Service-Now data for a ticket, without any local folder info.
 
     Args:
         instance (str): ServiceNow instance.
@@ -282,7 +511,7 @@ def fetch_ticket_info(instance, username, password, ticket_number):
         ticket_number (str): Ticket number.
 
     Returns:
-        dict: Dictionary containing the ticket information.
+        dict: Ticket record to be passed to build_ticket_info, otherwise None.
     """
     debug_logger.debug(f"Loading data for ticket: {ticket_number}")
     url_item = f"https://{instance}/api/now/table/sc_req_item?sysparm_query=number={ticket_number}"
@@ -293,8 +522,6 @@ def fetch_ticket_info(instance, username, password, ticket_number):
         # Confirm there is a result here
         if data_item['result']:
             item = data_item['result'][0]
-            sys_id = item['sys_id']
-            closed_at_utc = item.get('closed_at', 'N/A')
 
             # Find out if ticket is tagged with "Ready for Pickup" in Service-Now
             has_ready_for_pickup_tag = fetch_label_info(instance, username, password, ticket_number)
@@ -305,40 +532,449 @@ def fetch_ticket_info(instance, username, password, ticket_number):
             else:
                 closed_by_id = 'N/A'
 
-            # If ticket closed, then convert the "Closed at" time stamp to local time
-            if closed_at_utc != 'N/A' and closed_at_utc != '':
-                utc_time = datetime.strptime(closed_at_utc, '%Y-%m-%d %H:%M:%S')
-                local_tz = pytz.timezone('America/New_York')
-                local_time = utc_time.replace(tzinfo=pytz.utc).astimezone(local_tz)
-                closed_at_local = local_time.strftime('%Y-%m-%d %H:%M:%S %Z%z')
-                ready_for_deletion = (datetime.now(pytz.timezone('America/New_York')) - local_time > timedelta(weeks=2)) and not has_ready_for_pickup_tag
-            else:
-                closed_at_local = 'N/A'
-                ready_for_deletion = False
-
             # Call Service-Now API to fetch username associated with closed_by_id
             closed_by_username = fetch_username_info(instance, username, password, closed_by_id)
-            
-            # Determine if we need to check file size
-            if GET_SIZE_BOOL == True:
-                debug_logger.debug(f"Getting backup size info for ticket: {ticket_number}")
-                folder_size = human_readable_size(get_folder_size(os.path.join(BACKUPS_LOCATION, find_matching_folders(BACKUPS_LOCATION, ticket_number))))
-            else:
-                debug_logger.debug(f"Skipping backup size info for ticket: {ticket_number}")
-                folder_size = 0
 
-            # Returns JSON object to be entered as row data for DataTable in app_gui.py
             return {
-                'ticket_number': ticket_number,
-                'folder_name': find_matching_folder_name(BACKUPS_LOCATION, ticket_number) or find_matching_folder_name(DELETION_LOCATION, ticket_number),
-                'sys_id': sys_id,
-                'closed_at_local': closed_at_local,
+                'sys_id': item['sys_id'],
+                'active': item.get('active'),
+                'closed_at': item.get('closed_at', 'N/A'),
                 'closed_by_username': closed_by_username,
                 'has_ready_for_pickup_tag': has_ready_for_pickup_tag,
-                'ready_for_deletion': ready_for_deletion,
-                'folder_size': folder_size,
-                'url': f"https://{instance}/nav_to.do?uri=sc_req_item.do?sys_id={sys_id}"
+                'fetched_at': server_timestamp(response_item)
             }
     else:
         error_logger.error(f"Error fetching ticket info: {response_item.status_code} - {response_item.text}")
     return None
+
+def build_ticket_info(instance, ticket_number, record, local_info=None):
+    """
+    Combine a ticket record from Service-Now with the local backup folder info.
+
+    Args:
+        instance (str): ServiceNow instance.
+        ticket_number (str): Ticket number.
+        record (dict): Ticket record from fetch_ticket_record or the sync state.
+        local_info (dict): Entry from scan_local_backups. Looked up on disk if not given.
+
+    Returns:
+        dict: Dictionary containing the ticket information.
+    """
+    sys_id = record['sys_id']
+    closed_at_utc = record.get('closed_at', 'N/A')
+    has_ready_for_pickup_tag = record['has_ready_for_pickup_tag']
+
+    # If ticket closed, then convert the "Closed at" time stamp to local time
+    if closed_at_utc != 'N/A' and closed_at_utc != '':
+        utc_time = datetime.strptime(closed_at_utc, '%Y-%m-%d %H:%M:%S')
+        local_tz = pytz.timezone('America/New_York')
+        local_time = utc_time.replace(tzinfo=pytz.utc).astimezone(local_tz)
+        closed_at_local = local_time.strftime('%Y-%m-%d %H:%M:%S %Z%z')
+        ready_for_deletion = (datetime.now(pytz.timezone('America/New_York')) - local_time > RETENTION_PERIOD) and not has_ready_for_pickup_tag
+    else:
+        closed_at_local = 'N/A'
+        ready_for_deletion = False
+
+    if local_info is None:
+        folder_name = find_matching_folder_name(BACKUPS_LOCATION, ticket_number) or find_matching_folder_name(DELETION_LOCATION, ticket_number)
+
+        # Determine if we need to check file size
+        if GET_SIZE_BOOL == True:
+            debug_logger.debug(f"Getting backup size info for ticket: {ticket_number}")
+            folder_bytes = get_folder_size(os.path.join(BACKUPS_LOCATION, find_matching_folders(BACKUPS_LOCATION, ticket_number)))
+        else:
+            debug_logger.debug(f"Skipping backup size info for ticket: {ticket_number}")
+            folder_bytes = None
+    else:
+        folder_name = local_info['folder_name']
+        folder_bytes = local_info['folder_bytes']
+
+    folder_size = human_readable_size(folder_bytes) if folder_bytes is not None else 0
+
+    # Returns JSON object to be entered as row data for DataTable in app_gui.py
+    return {
+        'ticket_number': ticket_number,
+        'folder_name': folder_name,
+        'sys_id': sys_id,
+        'closed_at_local': closed_at_local,
+        'closed_by_username': record['closed_by_username'],
+        'has_ready_for_pickup_tag': has_ready_for_pickup_tag,
+        'ready_for_deletion': ready_for_deletion,
+        'folder_size': folder_size,
+        'folder_bytes': folder_bytes,
+        'url': f"https://{instance}/nav_to.do?uri=sc_req_item.do?sys_id={sys_id}"
+    }
+
+def fetch_ticket_info(instance, username, password, ticket_number):
+    """
+    Fetch the information of a ticket from the ServiceNow instance.
+
+    Args:
+        instance (str): ServiceNow instance.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        ticket_number (str): Ticket number.
+
+    Returns:
+        dict: Dictionary containing the ticket information.
+    """
+    record = fetch_ticket_record(instance, username, password, ticket_number)
+    if record:
+        return build_ticket_info(instance, ticket_number, record)
+    return None
+
+def load_sync_state(instance):
+    """
+    Load the delta sync state saved for a Service-Now instance.
+
+    Args:
+        instance (str): ServiceNow instance.
+
+    Returns:
+        dict: {'watermark': str or None, 'records': {ticket_number: record}}
+    """
+    try:
+        with open(SYNC_STATE_PATH) as f:
+            state = json.load(f).get(instance)
+        if state:
+            return state
+    except FileNotFoundError:
+        debug_logger.debug("No sync state found, doing a full load.")
+    except (json.JSONDecodeError, AttributeError):
+        error_logger.error(f"Error: {SYNC_STATE_PATH} is not valid, doing a full load.")
+    return {'watermark': None, 'records': {}}
+
+def save_sync_state(instance, state):
+    """
+    Save the delta sync state for a Service-Now instance, keeping other instances untouched.
+
+    Args:
+        instance (str): ServiceNow instance.
+        state (dict): {'watermark': str, 'records': {ticket_number: record}}
+    """
+    try:
+        with open(SYNC_STATE_PATH) as f:
+            all_states = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        all_states = {}
+    all_states[instance] = state
+    try:
+        with open(SYNC_STATE_PATH, 'w') as f:
+            json.dump(all_states, f)
+        debug_logger.debug(f"Saved sync state for {instance} at watermark {state['watermark']}")
+    except OSError as e:
+        error_logger.error(f"Error saving sync state: {e}")
+
+def fetch_ticket_changes(instance, username, password, records, watermark):
+    """
+    Update cached ticket records with the sc_req_item and label_entry rows changed since the watermark.
+
+    Removed labels do not show up as changed rows, so tickets cached with the
+    "Ready for Pickup" tag are checked for it again on every load.
+
+    Args:
+        instance (str): ServiceNow instance.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        records (dict): Cached records keyed by ticket number. Updated in place.
+        watermark (str): UTC time of the last successful load. Ex: '2025-03-01 14:05:09'
+
+    Returns:
+        str: New watermark to save once the load is complete, otherwise None on error.
+    """
+    ticket_numbers = list(records.keys())
+    new_watermark = None
+
+    for i in range(0, len(ticket_numbers), QUERY_BATCH_SIZE):
+        batch = ','.join(ticket_numbers[i:i + QUERY_BATCH_SIZE])
+
+        response_item = requests.get(
+            f"https://{instance}/api/now/table/sc_req_item",
+            params={
+                'sysparm_query': f"sys_updated_on>={watermark}^numberIN{batch}",
+                'sysparm_fields': 'number,sys_id,active,closed_at,closed_by.user_name',
+                'sysparm_exclude_reference_link': 'true'
+            },
+            auth=(username, password)
+        )
+        if response_item.status_code != 200:
+            error_logger.error(f"Error fetching changed tickets: {response_item.status_code} - {response_item.text}")
+            return None
+
+        # Server time of the first request, so changes made during this load are fetched again next time
+        new_watermark = new_watermark or server_timestamp(response_item)
+
+        for item in response_item.json()['result']:
+            record = records[item['number']]
+            record['sys_id'] = item['sys_id']
+            record['active'] = item.get('active')
+            record['closed_at'] = item.get('closed_at', 'N/A')
+            if item.get('active') == "false":
+                record['closed_by_username'] = item.get('closed_by.user_name') or 'N/A'
+            else:
+                record['closed_by_username'] = 'N/A'
+            debug_logger.debug(f"Ticket changed since last load: {item['number']}")
+
+        response_label_entry = requests.get(
+            f"https://{instance}/api/now/table/label_entry",
+            params={
+                'sysparm_query': f"sys_updated_on>={watermark}^label={READY_FOR_PICKUP_LABEL_ID}^id_displayIN{batch}",
+                'sysparm_fields': 'id_display',
+                'sysparm_exclude_reference_link': 'true'
+            },
+            auth=(username, password)
+        )
+        if response_label_entry.status_code != 200:
+            error_logger.error(f"Error fetching changed labels: {response_label_entry.status_code} - {response_label_entry.text}")
+            return None
+
+        for entry in response_label_entry.json()['result']:
+            if entry.get('id_display') in records:
+                records[entry['id_display']]['has_ready_for_pickup_tag'] = True
+                debug_logger.debug(f"Label changed since last load: {entry['id_display']}")
+
+        # Clear the tag on any tagged ticket that no longer has a "Ready for Pickup" label
+        tagged = [ticket_number for ticket_number in ticket_numbers[i:i + QUERY_BATCH_SIZE] if records[ticket_number]['has_ready_for_pickup_tag']]
+        if tagged:
+            response_tagged = requests.get(
+                f"https://{instance}/api/now/table/label_entry",
+                params={
+                    'sysparm_query': f"label={READY_FOR_PICKUP_LABEL_ID}^id_displayIN{','.join(tagged)}",
+                    'sysparm_fields': 'id_display',
+                    'sysparm_exclude_reference_link': 'true'
+                },
+                auth=(username, password)
+            )
+            if response_tagged.status_code != 200:
+                error_logger.error(f"Error fetching current labels: {response_tagged.status_code} - {response_tagged.text}")
+                return None
+
+            still_tagged = set(entry.get('id_display') for entry in response_tagged.json()['result'])
+            for ticket_number in tagged:
+                if ticket_number not in still_tagged:
+                    records[ticket_number]['has_ready_for_pickup_tag'] = False
+                    debug_logger.debug(f"Label removed since last load: {ticket_number}")
+
+    return new_watermark or watermark
+
+def fetch_table_rows(instance, username, password, table, params):
+    """
+    Stream rows from a Service-Now table one page at a time using sysparm_limit and sysparm_offset.
+
+    Only a single page is held in memory, however many rows the query matches.
+
+    Args:
+        instance (str): ServiceNow instance.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        table (str): Table name. Ex: 'sc_req_item'
+        params (dict): Extra Table API parameters such as sysparm_query and sysparm_fields.
+
+    Yields:
+        dict: One row of the table.
+
+    Raises:
+        requests.HTTPError: If Service-Now returns an error for any page.
+    """
+    url = f"https://{instance}/api/now/table/{table}"
+    offset = 0
+    while True:
+        response = requests.get(
+            url,
+            params={**params, 'sysparm_limit': PAGE_SIZE, 'sysparm_offset': offset},
+            auth=(username, password)
+        )
+        if response.status_code != 200:
+            error_logger.error(f"Error fetching {table} page at offset {offset}: {response.status_code} - {response.text}")
+            response.raise_for_status()
+
+        rows = response.json()['result']
+        debug_logger.debug(f"Fetched {len(rows)} {table} rows at offset {offset}")
+        # ACLs can filter rows out of a page, so only an empty page means the end
+        if not rows:
+            return
+        yield from rows
+        offset += PAGE_SIZE
+
+def fetch_closed_tickets_in_window(instance, username, password, ticket_numbers):
+    """
+    Fetch every ticket closed in the last RETENTION_WINDOW_DAYS, but longer ago than the retention period,
+    and join it against the local ticket numbers.
+
+    Rows for tickets without a local folder are dropped as they stream in, so memory
+    only grows with the number of local folders. Local tickets outside the window
+    are not returned and need fetch_ticket_record.
+
+    Args:
+        instance (str): ServiceNow instance.
+        username (str): Username for authentication.
+        password (str): Password for authentication.
+        ticket_numbers ([str]): Ticket numbers from scan_directory_for_tickets.
+
+    Returns:
+        dict: Ticket records keyed by ticket number, for local tickets closed within the window.
+    """
+    wanted = set(ticket_numbers)
+    now_utc = datetime.now(pytz.utc)
+    cutoff = (now_utc - RETENTION_PERIOD).strftime('%Y-%m-%d %H:%M:%S')
+    window_start = (now_utc - timedelta(days=RETENTION_WINDOW_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    query = f"active=false^closed_at<{cutoff}^closed_at>={window_start}"
+    fetched_at = now_utc.strftime('%Y-%m-%d %H:%M:%S')
+
+    records = {}
+    item_rows = fetch_table_rows(instance, username, password, 'sc_req_item', {
+        'sysparm_query': query + "^ORDERBYsys_id",
+        'sysparm_fields': 'number,sys_id,active,closed_at,closed_by.user_name',
+        'sysparm_exclude_reference_link': 'true'
+    })
+    for item in item_rows:
+        if item['number'] in wanted:
+            records[item['number']] = {
+                'sys_id': item['sys_id'],
+                'active': item.get('active'),
+                'closed_at': item.get('closed_at', 'N/A'),
+                'closed_by_username': item.get('closed_by.user_name') or 'N/A',
+                'has_ready_for_pickup_tag': False,
+                'fetched_at': fetched_at
+            }
+    debug_logger.debug(f"Windowed query matched {len(records)} of {len(wanted)} local tickets")
+
+    # Only the matched tickets are checked for labels, not every label in the instance
+    matched = list(records.keys())
+    for i in range(0, len(matched), QUERY_BATCH_SIZE):
+        label_rows = fetch_table_rows(instance, username, password, 'label_entry', {
+            'sysparm_query': f"label={READY_FOR_PICKUP_LABEL_ID}^id_displayIN{','.join(matched[i:i + QUERY_BATCH_SIZE])}^ORDERBYsys_id",
+            'sysparm_fields': 'id_display',
+            'sysparm_exclude_reference_link': 'true'
+        })
+        for entry in label_rows:
+            if entry.get('id_display') in records:
+                records[entry['id_display']]['has_ready_for_pickup_tag'] = True
+
+    return records
+
+class HashingWriter:
+    """
+    File-like wrapper that hashes everything written through it.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.fileobj.write(data)
+
+def file_sha256(file_path):
+    """
+    Calculate the sha256 of a file, reading it in chunks.
+
+    Args:
+        file_path (str): The path of the file.
+
+    Returns:
+        str: sha256 hex digest of the file.
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def archive_folder(folder_name, source_location):
+    """
+    Stream a folder into a compressed tarball in the ARCHIVE_LOCATION.
+
+    The tarball is written through tarfile's stream mode, so only a fixed size buffer
+    and the compressor state are held in memory however large the folder is.
+
+    Args:
+        folder_name (str): Name of the folder to archive.
+        source_location (str): Directory containing the folder.
+
+    Returns:
+        tuple: (archive file name, sha256 hex digest of the archive)
+
+    Raises:
+        OSError: If the archive cannot be written, or reading it back gives a different checksum.
+    """
+    # Timestamped so a folder archived again never replaces an older cold copy
+    timestamp = datetime.now().strftime("%Y_%m_%d_%H%M%S_%f")
+    archive_name = f"{folder_name}_{timestamp}.tar.{ARCHIVE_COMPRESSION}"
+    archive_path = os.path.join(ARCHIVE_LOCATION, archive_name)
+    partial_path = archive_path + '.part'
+
+    debug_logger.debug(f"Archiving {folder_name} to {archive_path}")
+    try:
+        with open(partial_path, 'wb') as f:
+            writer = HashingWriter(f)
+            with tarfile.open(fileobj=writer, mode=f'w|{ARCHIVE_COMPRESSION}') as tar:
+                tar.add(os.path.join(source_location, folder_name), arcname=folder_name)
+            # The source is deleted right after, so the archive must be on disk, not in the page cache
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    # Only a complete archive gets its final name
+    os.replace(partial_path, archive_path)
+
+    # Read the archive back from the volume to make sure it holds what was written
+    checksum = writer.sha256.hexdigest()
+    if file_sha256(archive_path) != checksum:
+        raise OSError(f"Checksum of {archive_path} does not match what was written")
+    return archive_name, checksum
+
+def archive_folders(folder_names, source_location=None, on_archived=None):
+    """
+    Archive folders in parallel and record their checksums in the manifest.
+
+    Every folder gets a new archive on every run, so its current contents are always what is kept.
+
+    Args:
+        folder_names ([str]): Names of the folders to archive.
+        source_location (str): Directory containing the folders. Defaults to DELETION_LOCATION.
+        on_archived (callable): Called with each folder name as soon as it is done.
+
+    Returns:
+        dict: {folder_name: True if the folder is archived, otherwise False}
+    """
+    source_location = source_location or DELETION_LOCATION
+    results = {folder_name: False for folder_name in folder_names}
+    try:
+        os.makedirs(ARCHIVE_LOCATION, exist_ok=True)
+    except OSError as e:
+        error_logger.error(f"Error: archive location {ARCHIVE_LOCATION} is not available: {e}")
+        return results
+
+    with profiling.profile_section('archive_folders'):
+        with ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS) as executor:
+            futures = {
+                executor.submit(archive_folder, folder_name, source_location): folder_name
+                for folder_name in folder_names
+            }
+            for future in as_completed(futures):
+                folder_name = futures[future]
+                try:
+                    archive_name, checksum = future.result()
+                except Exception as e:
+                    error_logger.error(f"Error archiving {folder_name}: {e}")
+                    continue
+
+                # An archive missing from the manifest does not count as archived
+                try:
+                    with open(os.path.join(ARCHIVE_LOCATION, ARCHIVE_MANIFEST), 'a') as f:
+                        f.write(f"{checksum}  {archive_name}\n")
+                        f.flush()
+                        os.fsync(f.fileno())
+                except OSError as e:
+                    error_logger.error(f"Error adding {archive_name} to the archive manifest: {e}")
+                    continue
+                ticket_logger.info(f'Archived backed up folder: {folder_name} to {archive_name}')
+                results[folder_name] = True
+                if on_archived:
+                    on_archived(folder_name)
+
+    return results
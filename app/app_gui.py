@@ -7,16 +7,26 @@ from textual.events import Key
 import webbrowser
 import asyncio
 import os
+import math
+import threading
 from app.api_utils import (
-    move_to_deletion_folder, scan_directory_for_tickets, fetch_ticket_info,
+    move_to_deletion_folder, scan_directory_for_tickets, scan_local_backups, size_local_backups, fetch_ticket_record, build_ticket_info,
+    fetch_ticket_changes, load_sync_state, save_sync_state, fetch_closed_tickets_in_window,
+    plan_space_reclamation, deletion_on_same_volume, human_readable_size, archive_folders,
     error_logger, debug_logger, adjust_path, perm_remove_directory,
-    BACKUPS_LOCATION, INSTANCE, DELETION_LOCATION, APPLICATION_PATH
+    BACKUPS_LOCATION, INSTANCE, DELETION_LOCATION, APPLICATION_PATH, DELTA_SYNC_BOOL,
+    WINDOWED_QUERY_BOOL, ARCHIVE_LOCATION, GET_SIZE_BOOL
 )
+from app.profiling import profile_section, pop_summaries
 
 class TicketApp(App):
     CSS_PATH = adjust_path(APPLICATION_PATH + "/style.tcss")
     selected_index: reactive[int] = reactive(0)
     ticket_info_list: reactive[list] = reactive([])
+    ticket_records: dict = {}
+    local_backups: dict = {}
+    local_scans: dict = {}
+    stop_scans: threading.Event = None
 
     is_deletion_list_created: bool = False
 
@@ -61,6 +71,7 @@ class TicketApp(App):
             "main_buttons",
             [
                 Button("Move to Deletion Folder", id="move_deletion"),
+                Button("Free Up Space", id="plan_reclaim"),
                 Button("Empty Delete Folder", id="perm_delete")
             ]
         )
@@ -116,6 +127,22 @@ class TicketApp(App):
         self.move_to_deletion_folder_container.id = "move_to_deletion_folder_container"
         self.move_to_deletion_folder_container.styles.display = "none" 
         yield self.move_to_deletion_folder_container
+
+        self.reclaim_container = self.create_container(
+            "reclaim_container",
+            [
+                Static("How much space needs to be freed? (GiB)", classes="bold"),
+                Input(id="reclaim_target", placeholder="GiB to free", type="number"),
+                Container(
+                    Button("Go Back", id="cancel_reclaim"),
+                    Button("Plan", id="run_reclaim_plan"),
+                    classes="button_container"
+                )
+            ]
+        )
+        self.reclaim_container.classes = "login_container"
+        self.reclaim_container.styles.display = "none"
+        yield self.reclaim_container
      
         #login_error = Static("Incorrect Username or Password. Quit application and try again")
         #login_error.id = "login_error"
@@ -205,6 +232,19 @@ class TicketApp(App):
         # Set default theme for app
         self.theme = "monokai"
 
+        # Scan the backups folder while the user logs in, it needs no credentials
+        self.stop_scans = threading.Event()
+        self.local_scans = {}
+        self.start_local_scan(BACKUPS_LOCATION)
+
+    def exit(self, *args, **kwargs) -> None:
+        """
+        Stop any background folder sizing before exiting, so quitting does not wait for it.
+        """
+        if self.stop_scans:
+            self.stop_scans.set()
+        super().exit(*args, **kwargs)
+
     async def login_button_press(self) -> None:
         self.hide("#login_container")
         self.hide("#main_container")
@@ -254,16 +294,90 @@ class TicketApp(App):
         await self.load_tickets(INSTANCE, self.username, self.password, BACKUPS_LOCATION, self.main_table)
         self.show('#' + self.main_container.id)
 
-    def acutally_delete_files_press(self) -> None:
+    def plan_reclaim_press(self) -> None:
+        self.hide("#main_container")
+        self.show("#reclaim_container")
+        self.query_one("#reclaim_target").focus()
+
+    def cancel_reclaim_press(self) -> None:
+        self.hide("#reclaim_container")
+        self.show("#main_container")
+        self.query_one("#data_table").focus()
+
+    async def run_reclaim_plan_press(self) -> None:
+        """
+        Plan which folders to move to free the requested space, then show them pre-selected for confirmation.
+        """
+        try:
+            target_gib = float(self.query_one("#reclaim_target").value)
+        except ValueError:
+            target_gib = 0
+        if not math.isfinite(target_gib) or target_gib <= 0:
+            self.notify(message="Enter the amount of space to free in GiB.", title="Error", severity="error")
+            return
+
+        target_bytes = int(target_gib * 1024 ** 3)
+
+        # Folders without a size from "get_size" are walked here, which can take a while
+        self.hide("#reclaim_container")
+        self.reset_progress_bar(len([info for info in self.ticket_info_list if info['ready_for_deletion']]))
+        self.query_one("#progress_label").update("Getting folder sizes...")
+        plan, planned_bytes = await asyncio.to_thread(
+            plan_space_reclamation, self.ticket_info_list, target_bytes,
+            on_sized=lambda folder: self.call_from_thread(self.update_progress, folder, "Sized")
+        )
+        same_volume = await asyncio.to_thread(deletion_on_same_volume)
+        self.hide("#progress_container")
+
+        self.show("#move_to_deletion_folder_container")
+        if not plan:
+            self.move_to_deletion_folder_confirmation_text.update("No tickets are ready for deletion.")
+        else:
+            self.create_marked_for_delete_checklist(plan, checked=True)
+            if planned_bytes >= target_bytes:
+                plan_text = f"Moving these {len(plan)} folders to the 'MARKED FOR DELETION' folder frees {human_readable_size(planned_bytes)} of the {target_gib:g} GiB requested."
+            else:
+                plan_text = f"Only {human_readable_size(planned_bytes)} can be freed, by moving all {len(plan)} of these folders to the 'MARKED FOR DELETION' folder."
+            # A move within the same volume is only a rename
+            if same_volume:
+                plan_text += " The space is only freed once the deletion folder is emptied."
+            self.move_to_deletion_folder_confirmation_text.update(plan_text)
+        self.move_to_deletion_folder_confirmation_text.recompose()
+        self.show('#' + self.move_to_deletion_folder_container_scroll.id)
+
+    async def acutally_delete_files_press(self) -> None:
         deletion_folders = os.listdir(os.path.abspath(DELETION_LOCATION))
-        for folder in deletion_folders:
-            self.perm_removal_progress(folder, len(deletion_folders))
-            is_deletion_complete = perm_remove_directory(folder)
 
-            if is_deletion_complete:
-                self.notify(message="Selected files permanently deleted.", title=f"{folder}: Done.", severity="information", timeout=15)
+        # Folders are only deleted once they have been archived, if archiving is set up
+        if ARCHIVE_LOCATION:
+            self.reset_progress_bar(len(deletion_folders))
+            try:
+                archived = await asyncio.to_thread(
+                    archive_folders, deletion_folders,
+                    on_archived=lambda folder: self.call_from_thread(self.update_progress, folder, "Archived")
+                )
+            except Exception as e:
+                error_logger.error(f"Error archiving folders: {e}")
+                archived = {}
+
+            if deletion_folders and not any(archived.values()):
+                self.notify(message="Nothing could be archived, so nothing was deleted. Check the archive location.", title="Archive Failed.", severity="error", timeout=15)
             else:
-                self.notify(message="Error during deletion process.", title=f"{folder} Failed.", severity="error", timeout=15)
+                for folder in deletion_folders:
+                    if not archived.get(folder):
+                        self.notify(message="Could not be archived, so it was not deleted.", title=f"{folder} Failed.", severity="error", timeout=15)
+            deletion_folders = [folder for folder in deletion_folders if archived.get(folder)]
+
+        with profile_section('perm_remove_directory'):
+            for folder in deletion_folders:
+                self.perm_removal_progress(folder, len(deletion_folders))
+                is_deletion_complete = perm_remove_directory(folder)
+
+                if is_deletion_complete:
+                    self.notify(message="Selected files permanently deleted.", title=f"{folder}: Done.", severity="information", timeout=15)
+                else:
+                    self.notify(message="Error during deletion process.", title=f"{folder} Failed.", severity="error", timeout=15)
+        self.notify_profile_summaries()
 
         self.hide('#' + self.perm_delete_container.id)
         self.hide('#progress_container')
@@ -289,7 +403,23 @@ class TicketApp(App):
         elif event.button.id == "back_to_main":
             await self.back_to_main()
         elif event.button.id == "acutally_delete_files":
-            self.acutally_delete_files_press()
+            await self.acutally_delete_files_press()
+        elif event.button.id == "plan_reclaim":
+            self.plan_reclaim_press()
+        elif event.button.id == "cancel_reclaim":
+            self.cancel_reclaim_press()
+        elif event.button.id == "run_reclaim_plan":
+            await self.run_reclaim_plan_press()
+
+    async def on_input_submitted(self, event) -> None:
+        """
+        Handle Enter in the space to free input the same as pressing "Plan".
+
+        Args:
+            event (Input.Submitted): The input submitted event.
+        """
+        if event.input.id == "reclaim_target":
+            await self.run_reclaim_plan_press()
 
     async def fetch_ticket_info_task(self, instance, username, password, ticket_number) -> None:
         """
@@ -302,8 +432,10 @@ class TicketApp(App):
             ticket_number (str): Ticket number.
         """
         try:
-            ticket_info = await asyncio.to_thread(fetch_ticket_info, instance, username, password, ticket_number)
-            if ticket_info:
+            record = await asyncio.to_thread(fetch_ticket_record, instance, username, password, ticket_number)
+            if record:
+                self.ticket_records[ticket_number] = record
+                ticket_info = await asyncio.to_thread(build_ticket_info, instance, ticket_number, record, self.local_backups.get(ticket_number))
                 debug_logger.debug(f"ticket_info is {ticket_info}")
                 self.ticket_info_list.append(ticket_info)
                 #self.call_later(self.update_progress)
@@ -321,6 +453,13 @@ class TicketApp(App):
             error_logger.error(f"Error fetching ticket info: {e}")
             return False
     
+    def notify_profile_summaries(self) -> None:
+        """
+        Show the top hot spots of every profiled section that finished since the last call.
+        """
+        for summary in pop_summaries():
+            self.notify(message=summary, title="Profile", severity="information", timeout=30)
+
     def update_progress(self, ticket_number, label_text="Loaded") -> None:
         """
         Update the progress bar by advancing its value.
@@ -346,7 +485,74 @@ class TicketApp(App):
         progress.recompose()
         self.update_progress(current, "Deleting")
 
+    def start_local_scan(self, directory) -> None:
+        """
+        Start listing a directory in the background, then sizing its folders if "get_size" is enabled.
+
+        Args:
+            directory (str): Directory of backup folders.
+        """
+        listing = asyncio.create_task(asyncio.to_thread(scan_local_backups, directory))
+        sizing = asyncio.create_task(self.size_local_scan(directory, listing))
+        self.local_scans[directory] = (listing, sizing)
+
+    async def size_local_scan(self, directory, listing) -> None:
+        """
+        Size the folders of a listing once it is done. Sizes are written into the listing in place.
+
+        Args:
+            directory (str): Directory of backup folders.
+            listing (asyncio.Task): Task running scan_local_backups for the directory.
+        """
+        local_backups = await listing
+        if GET_SIZE_BOOL == True:
+            await asyncio.to_thread(size_local_backups, directory, local_backups, self.stop_scans)
+
+    async def take_local_scan(self, directory):
+        """
+        Get the local folder listing for a directory, using the one started in on_mount if it has not been used yet.
+
+        The scan stays in local_scans until a load using it succeeds, so a retry after a failed login reuses it.
+
+        Args:
+            directory (str): Directory of backup folders.
+
+        Returns:
+            tuple: (result of scan_local_backups, task that finishes once the folders are sized)
+        """
+        if directory in self.local_scans:
+            debug_logger.debug(f"Using prefetched scan of {directory}")
+        else:
+            self.start_local_scan(directory)
+        listing, sizing = self.local_scans[directory]
+        return await listing, sizing
+
+    def join_folder_sizes(self) -> None:
+        """
+        Copy folder sizes finished after the ticket rows were built into the ticket information.
+        """
+        for info in self.ticket_info_list:
+            local_info = self.local_backups.get(info['ticket_number'])
+            if local_info and local_info['folder_bytes'] is not None:
+                info['folder_bytes'] = local_info['folder_bytes']
+                info['folder_size'] = human_readable_size(local_info['folder_bytes'])
+
     async def load_tickets(self, instance, username, password, directory, table) -> None:
+        """
+        Load ticket information for all tickets in the backups location, profiling the load if enabled.
+
+        Args:
+            instance (str): ServiceNow instance.
+            username (str): Username for authentication.
+            password (str): Password for authentication.
+            directory (str): Directory of backup folders.
+            table (DataTable): DataTable widget to populate with data.
+        """
+        with profile_section('load_tickets'):
+            await self.load_ticket_rows(instance, username, password, directory, table)
+        self.notify_profile_summaries()
+
+    async def load_ticket_rows(self, instance, username, password, directory, table) -> None:
         """
         Load ticket information for all tickets in the backups location.
 
@@ -357,15 +563,39 @@ class TicketApp(App):
             directory (str): Directory of backup folders.
             table (DataTable): DataTable widget to populate with data.
         """
-        ticket_numbers = scan_directory_for_tickets(directory)
         self.ticket_info_list = []
-        total_tickets = len(ticket_numbers)
-        
-        self.reset_progress_bar(total_tickets)
+        self.ticket_records = {}
 
         tasks = []
 
         try:
+            # Service-Now is queried as soon as the folders are listed, sizing carries on alongside
+            try:
+                self.local_backups, sizing = await self.take_local_scan(directory)
+            except OSError as e:
+                # A failed listing can't be reused, the next load lists the folder again
+                self.local_scans.pop(directory, None)
+                self.hide("#main_container")
+                self.hide("#progress_container")
+                self.show("#login_container")
+                error_logger.error(f"Error listing {directory}: {e}")
+                self.notify(message=f"Could not read {directory}.", title="Error", severity="error")
+                return
+
+            ticket_numbers = list(self.local_backups)
+            self.reset_progress_bar(len(ticket_numbers))
+
+            sync_state = None
+            if WINDOWED_QUERY_BOOL:
+                # Tickets outside the window still need the per-ticket fetch
+                ticket_numbers = await self.load_tickets_in_window(instance, username, password, ticket_numbers)
+            elif DELTA_SYNC_BOOL:
+                sync_state = await self.load_changed_tickets(instance, username, password, directory, ticket_numbers)
+                if sync_state is None:
+                    raise RuntimeError("unable to fetch changed tickets")
+                # Only tickets never loaded before need the full per-ticket fetch
+                ticket_numbers = [ticket_number for ticket_number in ticket_numbers if ticket_number not in sync_state['records']]
+
             for ticket_number in ticket_numbers:
                 task = asyncio.create_task(self.fetch_ticket_info_task(instance, username, password, ticket_number))
 
@@ -374,6 +604,14 @@ class TicketApp(App):
             await asyncio.gather(*tasks)
 
             if all(list(map(lambda task: task.result(), tasks))):
+                if sync_state is not None:
+                    await asyncio.to_thread(self.save_loaded_tickets, instance, sync_state)
+                if not sizing.done():
+                    self.query_one("#progress_label").update("Getting folder sizes...")
+                await sizing
+                self.join_folder_sizes()
+                # The next load lists the folder again, as folders may have been moved since
+                self.local_scans.pop(directory, None)
                 await self.populate_table(table)
             else:
                 self.hide("#main_container")
@@ -386,6 +624,82 @@ class TicketApp(App):
             error_logger.error(f"Exception raised during login: {e}")
             self.notify(message="Failed login/authentication with Service-Now.", title="Error", severity="error")
     
+    async def load_tickets_in_window(self, instance, username, password, ticket_numbers) -> list:
+        """
+        Load ticket information with a few paged queries for all tickets closed in the retention window.
+
+        Args:
+            instance (str): ServiceNow instance.
+            username (str): Username for authentication.
+            password (str): Password for authentication.
+            ticket_numbers ([str]): Ticket numbers found in the directory being loaded.
+
+        Returns:
+            list: Ticket numbers the window did not cover, still to be fetched one at a time.
+        """
+        records = await asyncio.to_thread(fetch_closed_tickets_in_window, instance, username, password, ticket_numbers)
+        for ticket_number, record in records.items():
+            ticket_info = await asyncio.to_thread(build_ticket_info, instance, ticket_number, record, self.local_backups.get(ticket_number))
+            self.ticket_info_list.append(ticket_info)
+            self.update_progress(ticket_number)
+        return [ticket_number for ticket_number in ticket_numbers if ticket_number not in records]
+
+    async def load_changed_tickets(self, instance, username, password, directory, ticket_numbers):
+        """
+        Load the saved sync state and refresh it with only the rows changed in Service-Now since the last load.
+
+        Args:
+            instance (str): ServiceNow instance.
+            username (str): Username for authentication.
+            password (str): Password for authentication.
+            directory (str): Directory of backup folders being loaded.
+            ticket_numbers ([str]): Ticket numbers found in the directory being loaded.
+
+        Returns:
+            dict: Sync state with up to date records, otherwise None if Service-Now could not be reached.
+        """
+        sync_state = await asyncio.to_thread(load_sync_state, instance)
+        if not sync_state['watermark']:
+            sync_state['records'] = {}
+            return sync_state
+
+        # Forget tickets whose folders no longer exist in either location, the loaded one is already listed
+        other_directory = DELETION_LOCATION if directory == BACKUPS_LOCATION else BACKUPS_LOCATION
+        on_disk = set(self.local_backups) | set(await asyncio.to_thread(scan_directory_for_tickets, other_directory))
+        sync_state['records'] = {ticket_number: record for ticket_number, record in sync_state['records'].items() if ticket_number in on_disk}
+
+        watermark = await asyncio.to_thread(fetch_ticket_changes, instance, username, password, sync_state['records'], sync_state['watermark'])
+        if watermark is None:
+            return None
+        sync_state['watermark'] = watermark
+
+        for ticket_number in ticket_numbers:
+            record = sync_state['records'].get(ticket_number)
+            if record:
+                ticket_info = await asyncio.to_thread(build_ticket_info, instance, ticket_number, record, self.local_backups.get(ticket_number))
+                self.ticket_info_list.append(ticket_info)
+                self.update_progress(ticket_number)
+        debug_logger.debug(f"Delta sync reused {len(self.ticket_info_list)} cached tickets")
+        return sync_state
+
+    def save_loaded_tickets(self, instance, sync_state) -> None:
+        """
+        Merge the tickets fetched in full during this load into the sync state and save it.
+
+        Args:
+            instance (str): ServiceNow instance.
+            sync_state (dict): Sync state returned by load_changed_tickets.
+        """
+        watermarks = [record['fetched_at'] for record in self.ticket_records.values()]
+        if sync_state['watermark']:
+            watermarks.append(sync_state['watermark'])
+        if not watermarks:
+            return
+        sync_state['records'].update(self.ticket_records)
+        # Oldest server time seen during this load, so nothing changed mid-load is skipped
+        sync_state['watermark'] = min(watermarks)
+        save_sync_state(instance, sync_state)
+
     async def populate_table(self, table) -> None:
         """
         Populate the data table with the fetched ticket information.
@@ -408,7 +722,7 @@ class TicketApp(App):
         self.hide("#progress_container")
         self.notify(message="Ticket info loaded.", title="Done.", severity="information", timeout=5)
 
-    def create_marked_for_delete_checklist(self, deletion_info_list) -> None:
+    def create_marked_for_delete_checklist(self, deletion_info_list, checked=False) -> None:
 
         self.move_to_deletion_folder_container_scroll.recompose()
 
@@ -417,6 +731,7 @@ class TicketApp(App):
             self.move_to_deletion_folder_container_scroll.mount(
                 Checkbox(
                     f"Name: {info['folder_name']} | Closed: {info['closed_at_local']} | Closed by: {info['closed_by_username']}",
+                    value=checked,
                     classes="deletion_queue",
                     id=f"checkbox_{info['ticket_number']}"
                 )
@@ -0,0 +1,212 @@
+import sys
+import time
+import threading
+import tracemalloc
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+profile_logger = logging.getLogger()
+
+# Turned on by the "profile" config key (see api_utils.py) or the --profile flag
+PROFILE_ENABLED = '--profile' in sys.argv
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+
+# Number of entries written to each report
+REPORT_TOP = 25
+
+# One line summaries of finished sections, waiting to be shown in the TUI
+_summaries = []
+_summaries_lock = threading.Lock()
+
+# Sections can overlap across threads, tracemalloc runs while any of them is active.
+# Peak memory seen by each active section so far, keyed by a per-section token
+_active_peaks = {}
+# Names of the other sections that ran at the same time as each active section
+_active_overlaps = {}
+_active_names = {}
+_tracing_lock = threading.Lock()
+
+def _fold_peak() -> None:
+    """
+    Add tracemalloc's peak since its last reset to every active section, then reset it.
+
+    Must be called with _tracing_lock held.
+    """
+    peak = tracemalloc.get_traced_memory()[1]
+    for token in _active_peaks:
+        _active_peaks[token] = max(_active_peaks[token], peak)
+    tracemalloc.reset_peak()
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every running thread at a fixed interval.
+
+    Only stacks that pass through this app's own modules are counted, so time spent
+    idle in the Textual event loop does not drown out the actual work. Work is spread
+    over worker threads, so threads belonging to other sections running at the same
+    time are counted too; reports list those sections.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        own_thread_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread_id:
+                    self._record(frame)
+
+    def _record(self, frame) -> None:
+        stack = []
+        in_app = False
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, frame.f_lineno, code.co_name))
+            if frame.f_globals.get('__name__', '').startswith('app.'):
+                in_app = True
+            frame = frame.f_back
+        if not in_app:
+            return
+
+        self.samples += 1
+        self.self_counts[stack[0]] += 1
+        # Count each function once per sample, even when it recurses
+        for filename_function in set((filename, function) for filename, _, function in stack):
+            self.total_counts[filename_function] += 1
+
+def _format_counts(title, counts, samples) -> list:
+    lines = [title]
+    for key, count in counts.most_common(REPORT_TOP):
+        if len(key) == 3:
+            location = f"{key[0]}:{key[1]} {key[2]}"
+        else:
+            location = f"{key[0]} {key[1]}"
+        lines.append(f"{count:>8} {count / samples:>7.1%}  {location}")
+    return lines
+
+def _write_reports(name, profiler, before, after, peak, elapsed, overlaps):
+    """
+    Write the CPU profile and allocation reports for a section next to the logs.
+
+    Returns:
+        str: One line summary of the section for the TUI.
+    """
+    # Microseconds keep two runs of a section in the same second apart
+    timestamp = datetime.now().strftime("%Y_%m_%d_%H%M%S_%f")
+    samples = max(profiler.samples, 1)
+
+    profile_lines = [
+        f"Section: {name}",
+        f"Wall time: {elapsed:.2f}s",
+        f"Samples: {profiler.samples} every {profiler.interval * 1000:.0f}ms",
+        "Threads: every thread running app code is sampled",
+        f"Also running (their samples are included): {', '.join(sorted(overlaps)) or 'none'}",
+        ""
+    ]
+    profile_lines += _format_counts("Self samples (file:line function):", profiler.self_counts, samples)
+    profile_lines.append("")
+    profile_lines += _format_counts("Total samples (file function):", profiler.total_counts, samples)
+    with open(f"profile_{name}_{timestamp}.txt", "w") as f:
+        f.write("\n".join(profile_lines) + "\n")
+
+    allocation_lines = [
+        f"Section: {name}",
+        f"Peak traced memory: {peak / (1024 * 1024):.2f} MiB",
+        "",
+        "Largest allocation changes:"
+    ]
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+    allocation_lines += [str(stat) for stat in stats[:REPORT_TOP]]
+    with open(f"allocations_{name}_{timestamp}.txt", "w") as f:
+        f.write("\n".join(allocation_lines) + "\n")
+
+    summary = f"{name}: {elapsed:.2f}s, peak {peak / (1024 * 1024):.1f} MiB"
+    hot_spots = profiler.self_counts.most_common(3)
+    if hot_spots:
+        summary += " | " + ", ".join(
+            f"{function} ({filename.replace(chr(92), '/').split('/')[-1]}:{lineno}) {count / samples:.0%}"
+            for (filename, lineno, function), count in hot_spots
+        )
+    return summary
+
+@contextmanager
+def profile_section(name):
+    """
+    Profile the enclosed code with a SamplingProfiler and tracemalloc snapshots if profiling is enabled.
+
+    Reports are written to "profile_<name>_<timestamp>.txt" and "allocations_<name>_<timestamp>.txt".
+    Peak memory is tracked per section, also when sections overlap.
+
+    Args:
+        name (str): Name of the section. Ex: 'load_tickets'
+    """
+    if not PROFILE_ENABLED:
+        yield
+        return
+
+    token = object()
+    with _tracing_lock:
+        if not _active_peaks:
+            tracemalloc.start()
+        else:
+            # Keep the peak the other active sections have seen before resetting it for this one
+            _fold_peak()
+        for other in _active_overlaps.values():
+            other.add(name)
+        _active_overlaps[token] = set(_active_names.values())
+        _active_names[token] = name
+        _active_peaks[token] = 0
+        before = tracemalloc.take_snapshot()
+    profiler = SamplingProfiler()
+    profiler.start()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        profiler.stop()
+        with _tracing_lock:
+            after = tracemalloc.take_snapshot()
+            _fold_peak()
+            peak = _active_peaks.pop(token)
+            overlaps = _active_overlaps.pop(token)
+            del _active_names[token]
+            if not _active_peaks:
+                tracemalloc.stop()
+        try:
+            summary = _write_reports(name, profiler, before, after, peak, elapsed, overlaps)
+            profile_logger.debug(f"Profile: {summary}")
+            with _summaries_lock:
+                _summaries.append(summary)
+        except Exception as e:
+            profile_logger.error(f"Error writing profile reports for {name}: {e}")
+
+def pop_summaries() -> list:
+    """
+    Take the summaries of all sections finished since the last call.
+
+    Returns:
+        list: One line summary per profiled section.
+    """
+    global _summaries
+    with _summaries_lock:
+        summaries, _summaries = _summaries, []
+    return summaries